@@ -3,22 +3,27 @@ import os
 
 os.environ['SSL_CERT_FILE'] = certifi.where()
 
-import uuid
-from datetime import datetime, timedelta
+import secrets
+import hmac
+import hashlib
+import time
+import re
+import gzip
 import asyncio
 import logging
 import sqlite3
-from contextlib import contextmanager
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import urlencode, quote
+import aiosqlite
 from aiohttp import web, ClientSession
-from aiohttp_cors import setup as cors_setup, ResourceOptions
 import discord
-from discord.ext import commands
 from dotenv import load_dotenv
 import aiohttp
-import smtplib
+import orjson
+import aiosmtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import json
 
 # Load environment variables
 load_dotenv()
@@ -31,9 +36,14 @@ REDIRECT_URI  = os.getenv("REDIRECT_URI")  # e.g. http://localhost:8080/callback
 GUILD_ID      = os.getenv("GUILD_ID")
 INVITE_URL    = os.getenv("INVITE_URL")      # post-role-assign redirect
 
+# Key used to sign invite/OAuth state tokens (falls back to the OAuth client secret)
+TOKEN_SECRET = (os.getenv("TOKEN_SECRET") or CLIENT_SECRET or "").encode()
+
 # Email configuration
 EMAIL_METHOD = os.getenv("EMAIL_METHOD", "sendgrid")  # "sendgrid" or "smtp"
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
+SENDGRID_URL = "https://api.sendgrid.com/v3/mail/send"
+SENDGRID_BATCH_SIZE = 1000  # SendGrid's limit on personalizations per request
 FROM_EMAIL = os.getenv("FROM_EMAIL", "contact@bitshala.org")
 FROM_NAME = os.getenv("FROM_NAME", "Bitshala Team")
 
@@ -42,9 +52,17 @@ SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_KEEPALIVE_INTERVAL = 60  # seconds between NOOPs on idle pooled connections
 
 # SQLite database path
 DB_PATH = os.getenv("DB_PATH", "tokens.db")
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "3"))  # seconds to wait on a locked database
+# How long an invite link (as sent in the welcome email) stays usable; default 30 days
+INVITE_VALID_MINUTES = int(os.getenv("INVITE_VALID_MINUTES", str(30 * 24 * 60)))
+# Scheduled purge of never-used invites, in seconds between runs (hourly by default); 0 disables it
+TOKEN_CLEANUP_INTERVAL = int(os.getenv("TOKEN_CLEANUP_INTERVAL", "3600"))
+TOKEN_PURGE_GRACE_DAYS = int(os.getenv("TOKEN_PURGE_GRACE_DAYS", "30"))  # kept this long past expiry
 
 # Cohort → Discord role ID map
 ROLE_MAP = {
@@ -53,6 +71,7 @@ ROLE_MAP = {
     "mb_cohort": os.getenv("ROLE_MASTER_ID"),
     "pb_cohort": os.getenv("ROLE_PB_ID"),
 }
+VALID_COHORTS = frozenset(ROLE_MAP)
 
 # Cohort display names
 COHORT_NAMES = {
@@ -62,53 +81,162 @@ COHORT_NAMES = {
     "pb_cohort": "Programming Bitcoin",
 }
 
+# Static part of the Discord OAuth authorize URL; only the state varies per request
+OAUTH_AUTHORIZE_PREFIX = "https://discord.com/oauth2/authorize?" + urlencode({
+    "client_id":     CLIENT_ID,
+    "redirect_uri":  REDIRECT_URI,
+    "response_type": "code",
+    "scope":         "identify guilds.join",
+}) + "&state="
+
+# Constant parts of the OAuth code-for-token exchange; only the code varies per request
+OAUTH_TOKEN_REQUEST = {
+    "client_id":     CLIENT_ID,
+    "client_secret": CLIENT_SECRET,
+    "grant_type":    "authorization_code",
+    "redirect_uri":  REDIRECT_URI,
+}
+OAUTH_TOKEN_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
 # SQLite setup and database initialization
+# id is assigned by SQLite; email stays unique (one registration per address)
+TOKENS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS tokens (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        token TEXT UNIQUE NOT NULL,
+        role_key TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        name TEXT,
+        location TEXT,
+        describe_yourself TEXT,
+        year TEXT,
+        background TEXT,
+        github TEXT,
+        time TEXT,
+        why TEXT,
+        skills TEXT,
+        books TEXT,
+        enrolled INTEGER NOT NULL DEFAULT 0,
+        cohort_name TEXT,
+        hear_from TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        expires_at INTEGER,
+        used INTEGER NOT NULL DEFAULT 0,
+        email_sent INTEGER NOT NULL DEFAULT 0
+    )
+'''
+TOKEN_DATA_COLUMNS = (
+    "token, role_key, email, name, location, describe_yourself, year, background, github, "
+    "time, why, skills, books, enrolled, cohort_name, hear_from, created_at, expires_at, "
+    "used, email_sent"
+)
+# Same columns read from an old table, whose flags could be NULL (e.g. "enrolled": null)
+OLD_TOKEN_DATA_COLUMNS = (
+    "token, role_key, email, name, location, describe_yourself, year, background, github, "
+    "time, why, skills, books, COALESCE(enrolled, 0), cohort_name, hear_from, created_at, "
+    "expires_at, COALESCE(used, 0), COALESCE(email_sent, 0)"
+)
+
+def migrate_tokens_table(conn):
+    """Rebuild a tokens table from the old schema (email primary key, computed id)."""
+    columns = conn.execute("PRAGMA table_info(tokens)").fetchall()
+    if not columns or any(name == "id" and pk for _, name, _, _, _, pk in columns):
+        return  # fresh database, or already keyed on id
+    
+    conn.execute("BEGIN")
+    conn.execute("ALTER TABLE tokens RENAME TO tokens_old")
+    conn.execute(TOKENS_TABLE_SQL)
+    conn.execute(f'''
+        INSERT INTO tokens ({TOKEN_DATA_COLUMNS})
+        SELECT {OLD_TOKEN_DATA_COLUMNS} FROM tokens_old ORDER BY created_at
+    ''')
+    conn.execute("DROP TABLE tokens_old")
+    conn.commit()
+
+# Bump when init_database gains a migration; stored in the file as PRAGMA user_version
+SCHEMA_VERSION = 2
+
 def init_database():
     """Initialize the SQLite database and create/update the tokens table."""
-    with sqlite3.connect(DB_PATH) as conn:
-        # Create the table with composite primary key (id, email)
+    with sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT) as conn:
+        # WAL turns token writes into sequential log appends; the mode persists in the file
+        conn.execute("PRAGMA journal_mode=WAL")
+        
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if version >= SCHEMA_VERSION:
+            return  # schema is current, skip the table checks and full-table fixups
+        
+        migrate_tokens_table(conn)
+        conn.execute(TOKENS_TABLE_SQL)
+        
+        # Expiry was never enforced for unsigned uuid tokens, so unused ones keep
+        # working with no expiry rather than failing on their old, short timestamp
         conn.execute('''
-            CREATE TABLE IF NOT EXISTS tokens (
-                id INTEGER,
-                token TEXT UNIQUE NOT NULL,
-                role_key TEXT NOT NULL,
-                email TEXT NOT NULL,
-                name TEXT,
-                location TEXT,
-                describe_yourself TEXT,
-                year TEXT,
-                background TEXT,
-                github TEXT,
-                time TEXT,
-                why TEXT,
-                skills TEXT,
-                books TEXT,
-                enrolled BOOLEAN DEFAULT FALSE,
-                cohort_name TEXT,
-                hear_from TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP,
-                used BOOLEAN DEFAULT FALSE,
-                email_sent BOOLEAN DEFAULT FALSE,
-                PRIMARY KEY (email)
-            )
+            UPDATE tokens SET expires_at = NULL
+            WHERE used = 0 AND length(token) = 32 AND instr(token, '.') = 0
+        ''')
+        # expires_at is stored as a unix timestamp; convert rows written before that
+        conn.execute('''
+            UPDATE tokens SET expires_at = CAST(strftime('%s', expires_at) AS INTEGER)
+            WHERE typeof(expires_at) = 'text'
         ''')
         
+        # token lookups already use the index behind its UNIQUE constraint;
+        # index expires_at so expiry cleanup is a range scan, not a table scan
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_tokens_expires_at
+            ON tokens(expires_at) WHERE expires_at IS NOT NULL
+        ''')
+        # the admin listing walks this backwards instead of sorting the table
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tokens_created_at ON tokens(created_at)')
+        
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         conn.commit()
 
-@contextmanager
-def get_db_connection():
-    """Context manager for database connections."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # Enable dict-like access to rows
-    try:
-        yield conn
-    finally:
-        conn.close()
+# Shared database connection, opened by main() on the running event loop
+db: aiosqlite.Connection | None = None
+db_lock = asyncio.Lock()
 
-def create_email_html(name, cohort_name, invite_url, server_name="Bitshala"):
-    """Create HTML email content"""
-    return f"""
+async def open_database():
+    """Open the shared database connection before the HTTP server accepts requests."""
+    global db
+    db = await aiosqlite.connect(DB_PATH, timeout=DB_TIMEOUT)
+    db.row_factory = aiosqlite.Row  # Enable dict-like access to rows
+    # NORMAL is crash-safe under WAL while skipping an fsync per commit
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache
+    await db.execute("PRAGMA mmap_size=268435456")
+
+async def close_database(app):
+    """Close the shared database connection on shutdown."""
+    await db.close()
+
+@asynccontextmanager
+async def get_db_connection():
+    """Async context manager giving exclusive use of the shared connection."""
+    # One request at a time, so transactions from concurrent handlers never interleave
+    async with db_lock:
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+
+# Statements run on the shared connection; sqlite3 caches the compiled form
+# per SQL string, so hot paths reuse one plan instead of re-parsing
+MARK_EMAIL_SENT_SQL = 'UPDATE tokens SET email_sent = ? WHERE token = ?'
+# Check and mark in one statement: only an unused, unexpired token is updated
+CONSUME_TOKEN_SQL = '''
+    UPDATE tokens SET used = 1
+    WHERE token = ? AND used = 0 AND (expires_at IS NULL OR expires_at > ?)
+    RETURNING role_key
+'''
+# Used rows are the registration record (and hold the email's UNIQUE slot), so never purge them
+PURGE_STALE_SQL = 'DELETE FROM tokens WHERE used = 0 AND expires_at IS NOT NULL AND expires_at < ?'
+
+# Static welcome email; placeholders are filled by create_email_html
+EMAIL_TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -210,8 +338,76 @@ def create_email_html(name, cohort_name, invite_url, server_name="Bitshala"):
 </html>
 """
 
-def send_email_smtp(to_email, subject, html_body):
-    """Send email using SMTP"""
+def create_email_html(name, cohort_name, invite_url, server_name="Bitshala"):
+    """Create HTML email content"""
+    return EMAIL_TEMPLATE.format(name=name, cohort_name=cohort_name,
+                                 invite_url=invite_url, server_name=server_name)
+
+class SMTPPool:
+    """A few SMTP connections kept logged in and reused, so a send skips the TCP/TLS/AUTH handshake."""
+    
+    def __init__(self, size):
+        self._idle = asyncio.Queue()
+        for _ in range(size):
+            self._idle.put_nowait(aiosmtplib.SMTP(
+                hostname=SMTP_SERVER, port=SMTP_PORT, start_tls=True,
+                username=SMTP_USER, password=SMTP_PASSWORD,
+            ))
+    
+    async def send(self, msg):
+        """Send msg on an idle connection, connecting (or reconnecting) it as needed."""
+        client = await self._idle.get()
+        try:
+            if not client.is_connected:
+                await client.connect()  # STARTTLS and login happen on connect
+            try:
+                await client.send_message(msg)
+            except aiosmtplib.SMTPServerDisconnected:
+                # The server dropped the idle connection; reconnect once and retry
+                client.close()
+                await client.connect()
+                await client.send_message(msg)
+        except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused):
+            raise  # the server rejected this message, the connection itself is fine
+        except BaseException:
+            client.close()  # unknown state, start fresh on next use
+            raise
+        finally:
+            self._idle.put_nowait(client)
+    
+    async def keepalive(self):
+        """Background task: NOOP idle connections so the server doesn't time them out."""
+        while True:
+            await asyncio.sleep(SMTP_KEEPALIVE_INTERVAL)
+            for _ in range(self._idle.qsize()):
+                client = self._idle.get_nowait()
+                try:
+                    if client.is_connected:
+                        await client.noop()
+                except aiosmtplib.SMTPException:
+                    client.close()
+                finally:
+                    self._idle.put_nowait(client)
+    
+    async def close(self):
+        """QUIT every idle connection."""
+        while not self._idle.empty():
+            client = self._idle.get_nowait()
+            if client.is_connected:
+                try:
+                    await client.quit()
+                except aiosmtplib.SMTPException:
+                    client.close()
+
+smtp_pool = SMTPPool(SMTP_POOL_SIZE)
+
+async def close_smtp_pool(app):
+    """Stop the keepalive task and log out of the SMTP server on shutdown."""
+    app[SMTP_KEEPALIVE_KEY].cancel()
+    await smtp_pool.close()
+
+async def send_email_smtp(to_email, subject, html_body):
+    """Send email using SMTP without blocking the event loop"""
     try:
         msg = MIMEMultipart('alternative')
         msg['From'] = f"{FROM_NAME} <{FROM_EMAIL}>"
@@ -221,36 +417,117 @@ def send_email_smtp(to_email, subject, html_body):
         html_part = MIMEText(html_body, 'html')
         msg.attach(html_part)
         
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
+        await smtp_pool.send(msg)
         
         return True
     except Exception as e:
         logging.error(f"Failed to send email via SMTP: {e}")
         return False
 
+async def post_to_sendgrid(payload):
+    """POST a v3 mail/send payload, gzipped, on the shared session.
+    Returns the response status (202 when accepted), or None if the request failed."""
+    try:
+        async with app[HTTP_SESSION_KEY].post(
+            SENDGRID_URL,
+            data=gzip.compress(orjson.dumps(payload)),
+            headers={
+                "Authorization": f"Bearer {SENDGRID_API_KEY}",
+                "Content-Type": "application/json",
+                "Content-Encoding": "gzip",
+            },
+        ) as resp:
+            if resp.status != 202:
+                logging.error(f"SendGrid rejected email ({resp.status}): {await resp.text()}")
+            return resp.status
+    except Exception as e:
+        logging.error(f"Failed to send email via SendGrid: {e}")
+        return None
+
+async def send_email_sendgrid(to_email, subject, html_body):
+    """Send email through SendGrid's v3 API with a gzipped body on the shared session"""
+    status = await post_to_sendgrid({
+        "personalizations": [{"to": [{"email": to_email}]}],
+        "from": {"email": FROM_EMAIL, "name": FROM_NAME},
+        "subject": subject,
+        "content": [{"type": "text/html", "value": html_body}],
+    })
+    return status == 202
+
+def invite_url_for(cohort, token):
+    """Link to the invite route that starts the OAuth flow for this token."""
+    return f"{REDIRECT_URI.replace('/discord/callback', '')}/invite/{cohort}?token={token}"
+
+def welcome_subject(cohort_name):
+    """Subject line of the welcome email."""
+    return f"🎉 Welcome to {cohort_name} - Join our Discord!"
+
+# One shared body for batched sends; SendGrid fills these tags per recipient
+WELCOME_EMAIL_BATCH_HTML = create_email_html("-name-", "-cohort_name-", "-invite_url-")
+
+async def send_welcome_emails_sendgrid(invites):
+    """Send welcome emails for many (email, name, cohort, token) invites, up to
+    SENDGRID_BATCH_SIZE per request. Returns one success flag per invite."""
+    results = []
+    for start in range(0, len(invites), SENDGRID_BATCH_SIZE):
+        batch = invites[start:start + SENDGRID_BATCH_SIZE]
+        personalizations = []
+        for email, name, cohort, token in batch:
+            cohort_name = COHORT_NAMES.get(cohort, f"{cohort} Cohort")
+            personalizations.append({
+                "to": [{"email": email}],
+                "subject": welcome_subject(cohort_name),
+                # SendGrid rejects the whole request if any value isn't a string
+                "substitutions": {
+                    "-name-": str(name or ""),
+                    "-cohort_name-": str(cohort_name),
+                    "-invite_url-": str(invite_url_for(cohort, token)),
+                },
+            })
+        status = await post_to_sendgrid({
+            "personalizations": personalizations,
+            "from": {"email": FROM_EMAIL, "name": FROM_NAME},
+            "content": [{"type": "text/html", "value": WELCOME_EMAIL_BATCH_HTML}],
+        })
+        if status is not None and 400 <= status < 500 and status != 429 and len(batch) > 1:
+            # One bad recipient fails the whole request; send the batch one by one
+            # so only the offending invites are marked unsent
+            singles = []
+            for email, name, cohort, token in batch:
+                cohort_name = COHORT_NAMES.get(cohort, f"{cohort} Cohort")
+                html_body = create_email_html(name, cohort_name, invite_url_for(cohort, token))
+                singles.append(send_email_sendgrid(email, welcome_subject(cohort_name), html_body))
+            results.extend(await asyncio.gather(*singles))
+        else:
+            results.extend([status == 202] * len(batch))
+    
+    async with get_db_connection() as conn:
+        await conn.executemany(MARK_EMAIL_SENT_SQL, [
+            (int(sent), token) for sent, (_, _, _, token) in zip(results, invites)
+        ])
+        await conn.commit()
+    
+    return results
+
 async def send_welcome_email(email, name, cohort, token):
     """Send welcome email with Discord invite link"""
     try:
         cohort_name = COHORT_NAMES.get(cohort, f"{cohort} Cohort")
-        invite_url = f"{REDIRECT_URI.replace('/discord/callback', '')}/invite/{cohort}?token={token}"
+        invite_url = invite_url_for(cohort, token)
         
-        subject = f"🎉 Welcome to {cohort_name} - Join our Discord!"
+        subject = welcome_subject(cohort_name)
         html_body = create_email_html(name, cohort_name, invite_url)
         
-        success = send_email_smtp(email, subject, html_body)
+        # SMTP stays the fallback so deployments without an API key keep working
+        if EMAIL_METHOD == "sendgrid" and SENDGRID_API_KEY:
+            success = await send_email_sendgrid(email, subject, html_body)
+        else:
+            success = await send_email_smtp(email, subject, html_body)
         
         # Update email_sent status in database
-        with get_db_connection() as conn:
-            conn.execute('''
-                UPDATE tokens 
-                SET email_sent = ? 
-                WHERE token = ?
-            ''', (success, token))
-            conn.commit()
+        async with get_db_connection() as conn:
+            await conn.execute(MARK_EMAIL_SENT_SQL, (int(success), token))
+            await conn.commit()
         
         return success
         
@@ -258,111 +535,189 @@ async def send_welcome_email(email, name, cohort, token):
         logging.error(f"Error sending welcome email: {e}")
         return False
 
+# Signed tokens: "<role_key>.<nonce>.<expiry>.<hmac>", verifiable without the database.
+# The role segment matches the configured cohorts exactly, whatever their spelling.
+TOKEN_RE = re.compile(
+    "(?:" + "|".join(sorted(map(re.escape, VALID_COHORTS))) + ")"
+    r"\.[A-Za-z0-9_-]{22}\.[0-9]{1,12}\.[0-9a-f]{64}"
+)
+# Unsigned uuid4().hex tokens issued before signing; links already in inboxes must keep working
+LEGACY_TOKEN_RE = re.compile(r"[0-9a-f]{32}")
+
+def sign_token_payload(payload: str) -> str:
+    """Return the HMAC-SHA256 signature of a token payload."""
+    return hmac.new(TOKEN_SECRET, payload.encode(), hashlib.sha256).hexdigest()
+
+def issue_token(role_key: str, valid_minutes: int) -> tuple[str, int]:
+    """Build a signed token. Returns (token, expiry as a unix timestamp)."""
+    expires_ts = int(time.time()) + valid_minutes * 60
+    payload = f"{role_key}.{secrets.token_urlsafe(16)}.{expires_ts}"
+    return f"{payload}.{sign_token_payload(payload)}", expires_ts
+
+def verify_token(token: str) -> str | None:
+    """Check a token's signature and expiry locally. Returns role_key if valid, None otherwise."""
+    try:
+        payload, signature = token.rsplit(".", 1)
+        role_key, _nonce, expires_ts = payload.split(".")
+        expires_ts = int(expires_ts)
+    except (AttributeError, ValueError):
+        return None
+    
+    if not hmac.compare_digest(signature, sign_token_payload(payload)):
+        return None
+    if expires_ts < time.time():
+        return None
+    return role_key
+
+# Correctly signed tokens that can never succeed again (consumed here, or found
+# used/missing/expired in the database), so OAuth retries and replay probes are
+# rejected without a database round-trip. Forged tokens never reach this cache,
+# and neither do unknown legacy tokens, which anyone can make up.
+SPENT_TOKEN_CACHE_SIZE = 10_000
+_spent_tokens: OrderedDict[str, None] = OrderedDict()
+
+def remember_spent_token(token: str):
+    """Record a spent token, evicting the least recently seen entry once the cache is full."""
+    _spent_tokens[token] = None
+    if len(_spent_tokens) > SPENT_TOKEN_CACHE_SIZE:
+        _spent_tokens.popitem(last=False)
+
+# Token rows waiting to be written; concurrent registrations share one transaction
+TOKEN_BATCH_SIZE = 100
+pending_tokens: asyncio.Queue = asyncio.Queue()
+
+INSERT_TOKEN_SQL = '''
+    INSERT INTO tokens (token, role_key, email, name, location, describe_yourself, 
+                      year, background, github, time, why, skills, books, enrolled, 
+                      cohort_name, hear_from, expires_at, used, email_sent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+async def write_token_batch(batch):
+    """Insert queued (row, future) pairs in one transaction and resolve their futures."""
+    try:
+        async with get_db_connection() as conn:
+            await conn.executemany(INSERT_TOKEN_SQL, [row for row, _ in batch])
+            await conn.commit()
+        results = [None] * len(batch)
+    except sqlite3.IntegrityError:
+        # One bad row (e.g. an already-registered email) fails the whole batch;
+        # retry row by row so each caller gets its own outcome
+        results = []
+        for row, _ in batch:
+            try:
+                async with get_db_connection() as conn:
+                    await conn.execute(INSERT_TOKEN_SQL, row)
+                    await conn.commit()
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+    except Exception as e:
+        results = [e] * len(batch)
+    
+    for (_, written), error in zip(batch, results):
+        if written.done():  # caller went away
+            continue
+        if error:
+            written.set_exception(error)
+        else:
+            written.set_result(None)
+
+async def flush_pending_tokens():
+    """Background task: drain the token queue, writing whatever has piled up per transaction."""
+    while True:
+        batch = [await pending_tokens.get()]
+        # Rows queued while the previous batch was committing go out together
+        while len(batch) < TOKEN_BATCH_SIZE and not pending_tokens.empty():
+            batch.append(pending_tokens.get_nowait())
+        await write_token_batch(batch)
+
+async def stop_token_writer(app):
+    """Cancel the token writer task on shutdown."""
+    app[TOKEN_WRITER_KEY].cancel()
+
 # Token management with SQLite (updated to include email)
-def create_token(role_key: str, email: str = None, name: str = None, location: str = None, 
+async def create_token(role_key: str, email: str = None, name: str = None, location: str = None, 
                  describe_yourself: str = None, year: str = None, background: str = None, 
                  github: str = None, time: str = None, why: str = None, skills: list = None, 
                  books: list = None, enrolled: bool = False, cohort_name: str = None, 
-                 hear_from: str = None, valid_minutes: int = 60) -> str:
+                 hear_from: str = None, valid_minutes: int = INVITE_VALID_MINUTES) -> str:
     """Create a new token for the specified role with all user data."""
-    token = uuid.uuid4().hex
-    expires_at = datetime.utcnow() + timedelta(minutes=valid_minutes)
+    token, expires_at = issue_token(role_key, valid_minutes)
     
     if not email:
         raise ValueError("Email is required for token creation")
+    if role_key not in VALID_COHORTS:
+        raise ValueError(f"Invalid cohort: {role_key}")
     
     # Convert lists to JSON strings for storage
-    skills_json = json.dumps(skills) if skills else None
-    books_json = json.dumps(books) if books else None
+    skills_json = orjson_dumps(skills) if skills else None
+    books_json = orjson_dumps(books) if books else None
     
-    with get_db_connection() as conn:
-        # Get the next available ID for this email
-        cursor = conn.execute('''
-            SELECT COALESCE(MAX(id), 0) + 1 as next_id 
-            FROM tokens 
-            WHERE email = ?
-        ''', (email,))
-        next_id = cursor.fetchone()[0]
-        
-        conn.execute('''
-            INSERT INTO tokens (id, token, role_key, email, name, location, describe_yourself, 
-                              year, background, github, time, why, skills, books, enrolled, 
-                              cohort_name, hear_from, expires_at, used, email_sent)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (next_id, token, role_key, email, name, location, describe_yourself, year, 
-              background, github, time, why, skills_json, books_json, enrolled, cohort_name, 
-              hear_from, expires_at, False, False))
-        conn.commit()
+    # Queue the row for the batched writer and wait until it has been committed
+    row = (token, role_key, email, name, location, describe_yourself, year,
+           background, github, time, why, skills_json, books_json, 1 if enrolled else 0,
+           cohort_name, hear_from, expires_at, 0, 0)
+    written = asyncio.get_running_loop().create_future()
+    pending_tokens.put_nowait((row, written))
+    await written
     
     return token
 
-def validate_and_mark(token: str) -> str | None:
+async def validate_and_mark(token: str) -> str | None:
     """Validate token and mark it as used atomically. Returns role_key if valid, None otherwise."""
-    now = datetime.utcnow()
+    legacy = LEGACY_TOKEN_RE.fullmatch(token) is not None
+    # Forged, malformed and expired signed tokens are rejected without touching the database;
+    # legacy tokens carry no signature, so only the database can check them
+    if not legacy and not verify_token(token):
+        return None
+    if token in _spent_tokens:
+        _spent_tokens.move_to_end(token)
+        return None
     
-    with get_db_connection() as conn:
-        # Start a transaction
-        conn.execute('BEGIN IMMEDIATE')
-        
+    now = int(time.time())
+    
+    async with get_db_connection() as conn:
         try:
-            # Find the token
-            cursor = conn.execute('''
-                SELECT role_key, used, expires_at 
-                FROM tokens 
-                WHERE token = ?
-            ''', (token,))
-            
-            row = cursor.fetchone()
-            
-            if not row:
-                conn.rollback()
-                return None
-            
-            # Check if already used
-            if row['used']:
-                conn.rollback()
-                return None
+            cursor = await conn.execute(CONSUME_TOKEN_SQL, (token, now))
+            row = await cursor.fetchone()
+            await conn.commit()
             
-            # Check if expired (optional - uncomment if you want expiration)
-            # if row['expires_at'] and datetime.fromisoformat(row['expires_at']) < now:
-            #     conn.rollback()
-            #     return None
-            
-            # Mark as used
-            conn.execute('''
-                UPDATE tokens 
-                SET used = TRUE 
-                WHERE token = ?
-            ''', (token,))
-            
-            conn.commit()
-            return row['role_key']
+            if row or not legacy:
+                remember_spent_token(token)  # single use: it won't validate again either way
+            return row['role_key'] if row else None  # no row: unknown, already used or expired
             
         except Exception as e:
-            conn.rollback()
+            await conn.rollback()
             logging.error(f"Error validating token: {e}")
             return None
 
-def cleanup_expired_tokens():
-    """Remove expired tokens from the database."""
-    now = datetime.utcnow()
-    with get_db_connection() as conn:
-        conn.execute('''
-            DELETE FROM tokens 
-            WHERE expires_at IS NOT NULL AND expires_at < ?
-        ''', (now,))
-        conn.commit()
+async def purge_stale_tokens():
+    """Remove never-used tokens that expired more than TOKEN_PURGE_GRACE_DAYS ago."""
+    cutoff = int(time.time()) - TOKEN_PURGE_GRACE_DAYS * 86400
+    async with get_db_connection() as conn:
+        await conn.execute(PURGE_STALE_SQL, (cutoff,))
+        await conn.commit()
+
+async def purge_stale_tokens_periodically():
+    """Background task: purge stale tokens every TOKEN_CLEANUP_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(TOKEN_CLEANUP_INTERVAL)
+        try:
+            await purge_stale_tokens()
+        except Exception as e:
+            logging.error(f"Error purging stale tokens: {e}")
+
+async def stop_token_cleanup(app):
+    """Cancel the periodic cleanup task on shutdown."""
+    app[TOKEN_CLEANUP_KEY].cancel()
 
 # Discord bot setup
-intents = discord.Intents.default()
-intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Only the bot's REST client is used (members are added over HTTP), so the bot
+# logs in without opening a gateway connection and receives no events
+bot = discord.Client(intents=discord.Intents.none())
 logging.basicConfig(level=logging.INFO)
 
-@bot.event
-async def on_ready():
-    print(f"Bot logged in as {bot.user} ({bot.user.id})")
-
 # HTTP server for invite & callback
 routes = web.RouteTableDef()
 
@@ -372,62 +727,58 @@ async def register_user(request):
     """Handle registration requests from frontend - alias for /bot/invite"""
     return await send_invite_email(request)
 
+def invite_fields(data):
+    """Map an invite payload from the frontend/Rust service to create_token arguments."""
+    return {
+        "role_key": data.get('role'),
+        "email": data.get('email'),
+        "name": data.get('name'),
+        "location": data.get('location'),
+        "describe_yourself": data.get('describeYourself'),
+        "year": data.get('year'),
+        "background": data.get('background'),
+        "github": data.get('github'),
+        "time": data.get('time'),
+        "why": data.get('why'),
+        "skills": data.get('skills', []),
+        "books": data.get('books', []),
+        "enrolled": data.get('enrolled', False),
+        "cohort_name": data.get('cohortName'),
+        "hear_from": data.get('hearFrom'),
+    }
+
+# Deliberately loose: catches typos and junk before a token row is written
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+def invite_error(fields):
+    """Return why an invite can't be created, or None if it's valid."""
+    if not all([fields["name"], fields["email"], fields["role_key"]]):
+        return "Missing required fields: name, email, cohort"
+    if fields["role_key"] not in VALID_COHORTS:
+        return f"Invalid cohort: {fields['role_key']}"
+    if not isinstance(fields["email"], str) or not EMAIL_RE.fullmatch(fields["email"]):
+        return f"Invalid email: {fields['email']}"
+    return None
+
 # New route to handle registration and email sending from Rust
 @routes.post("/bot/invite")
 async def send_invite_email(request):
     """Handle email invitation requests from Rust service"""
     try:
-        data = await request.json()
-        name = data.get('name')
-        email = data.get('email')
-        cohort = data.get('role')
-        location = data.get('location')
-        describe_yourself = data.get('describeYourself')
-        year = data.get('year')
-        background = data.get('background')
-        github = data.get('github')
-        time = data.get('time')
-        why = data.get('why')
-        skills = data.get('skills', [])
-        books = data.get('books', [])
-        enrolled = data.get('enrolled', False)
-        cohort_name = data.get('cohortName')
-        hear_from = data.get('hearFrom')
+        data = orjson.loads(await request.read())
+        if not isinstance(data, dict):
+            return json_response({"error": "Invalid JSON payload", "status": "ERROR"}, status=400)
+        fields = invite_fields(data)
+        name, email, cohort = fields["name"], fields["email"], fields["role_key"]
         
         print(data)
         
-        # Validate required fields
-        if not all([name, email, cohort]):
-            return web.json_response(
-                {"error": "Missing required fields: name, email, cohort", "status": "ERROR"}, 
-                status=400
-            )
-        
-        # Validate cohort
-        if cohort not in ROLE_MAP:
-            return web.json_response(
-                {"error": f"Invalid cohort: {cohort}", "status": "ERROR"}, 
-                status=400
-            )
+        error = invite_error(fields)
+        if error:
+            return json_response({"error": error, "status": "ERROR"}, status=400)
         
         # Create token with all user data
-        token = create_token(
-            role_key=cohort, 
-            email=email, 
-            name=name,
-            location=location,
-            describe_yourself=describe_yourself,
-            year=year,
-            background=background,
-            github=github,
-            time=time,
-            why=why,
-            skills=skills,
-            books=books,
-            enrolled=enrolled,
-            cohort_name=cohort_name,
-            hear_from=hear_from
-        )
+        token = await create_token(**fields)
         
         # Send welcome email
         email_sent = await send_welcome_email(email, name, cohort, token)
@@ -438,7 +789,7 @@ async def send_invite_email(request):
         
         if email_sent:
             logging.info(f"Successfully sent invite email to {email} for cohort {cohort}")
-            return web.json_response({
+            return json_response({
                 "invite_link": invite_url,
                 "status": "SENT",
                 "message": "Email sent successfully",
@@ -446,30 +797,79 @@ async def send_invite_email(request):
             })
         else:
             logging.error(f"Failed to send email to {email}")
-            return web.json_response({
+            return json_response({
                 "invite_link": invite_url,
                 "status": "EMAIL_FAILED",
                 "message": "Failed to send email, but token created",
                 "token": token
             }, status=500)
             
-    except json.JSONDecodeError:
-        return web.json_response(
+    except orjson.JSONDecodeError:
+        return json_response(
             {"error": "Invalid JSON payload", "status": "ERROR"}, 
             status=400
         )
     except Exception as e:
         logging.error(f"Error in send_invite_email: {e}")
-        return web.json_response(
+        return json_response(
             {"error": str(e), "status": "ERROR"}, 
             status=500
         )
 
+BULK_INVITE_MAX = 1000
+
+@routes.post("/bot/invite/bulk")
+async def send_invite_emails_bulk(request):
+    """Handle {"invites": [...]} from the Rust service: one result per invite, in order"""
+    try:
+        data = orjson.loads(await request.read())
+    except orjson.JSONDecodeError:
+        return json_response({"error": "Invalid JSON payload", "status": "ERROR"}, status=400)
+    invites = data.get("invites") if isinstance(data, dict) else None
+    if not isinstance(invites, list) or not all(isinstance(i, dict) for i in invites):
+        return json_response({"error": "Expected {\"invites\": [...]}", "status": "ERROR"}, status=400)
+    if len(invites) > BULK_INVITE_MAX:
+        return json_response(
+            {"error": f"At most {BULK_INVITE_MAX} invites per request", "status": "ERROR"}, status=400
+        )
+    
+    results = [{"email": invite.get("email")} for invite in invites]
+    valid = []
+    for result, invite in zip(results, invites):
+        fields = invite_fields(invite)
+        error = invite_error(fields)
+        if error:
+            result.update(status="ERROR", error=error)
+        else:
+            valid.append((result, fields))
+    
+    # Concurrent create_token calls share the token writer's batched transactions
+    tokens = await asyncio.gather(
+        *(create_token(**fields) for _, fields in valid), return_exceptions=True
+    )
+    created = []
+    for (result, fields), token in zip(valid, tokens):
+        if isinstance(token, Exception):
+            result.update(status="ERROR", error=str(token))
+        else:
+            result["token"] = token
+            created.append((result, (fields["email"], fields["name"], fields["role_key"], token)))
+    
+    if EMAIL_METHOD == "sendgrid" and SENDGRID_API_KEY:
+        sent = await send_welcome_emails_sendgrid([invite for _, invite in created])
+    else:
+        sent = await asyncio.gather(*(send_welcome_email(*invite) for _, invite in created))
+    for (result, _), email_sent in zip(created, sent):
+        result["status"] = "SENT" if email_sent else "EMAIL_FAILED"
+    
+    logging.info(f"Bulk invite: {len(created)} of {len(invites)} tokens created")
+    return json_response({"results": results})
+
 
 @routes.get("/invite/{cohort}")
 async def invite(request):
     cohort = request.match_info["cohort"]
-    if cohort not in ROLE_MAP:
+    if cohort not in VALID_COHORTS:
         return web.Response(text="Invalid cohort", status=400)
 
     # Check if token is provided in query params (from email link)
@@ -480,66 +880,110 @@ async def invite(request):
         token = provided_token
     else:
         # Create a new token (legacy behavior)
-        token = create_token(cohort)
-
-    params = {
-        "client_id":     CLIENT_ID,
-        "redirect_uri":  REDIRECT_URI,
-        "response_type": "code",
-        "scope":         "identify guilds.join",
-        "state":         token
-    }
-    import urllib.parse
-    oauth_url = "https://discord.com/oauth2/authorize?" + urllib.parse.urlencode(params)
-    raise web.HTTPFound(location=oauth_url)
+        token = await create_token(cohort)
+
+    raise web.HTTPFound(location=OAUTH_AUTHORIZE_PREFIX + quote(token))
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+background_tasks = set()
+BACKGROUND_DRAIN_TIMEOUT = 10.0  # seconds shutdown waits for in-flight member adds
+
+async def add_member_with_role(user_id, access_token, role_id):
+    """Add a user to the guild with the cohort role, logging any failure."""
+    # Goes through discord.py's HTTP client: its pooled session and 429/retry-after handling
+    route = discord.http.Route(
+        "PUT", "/guilds/{guild_id}/members/{user_id}", guild_id=GUILD_ID, user_id=user_id
+    )
+    try:
+        await app[BOT_LOGIN_KEY]  # a callback can arrive while main() is still logging in
+        # Join and role assignment in one call. Discord answers 204 (empty body) and ignores
+        # "roles" when the user is already a member, so only then assign the role separately.
+        member = await bot.http.request(route, json={"access_token": access_token, "roles": [role_id]})
+        if not member:
+            await bot.http.add_role(GUILD_ID, user_id, role_id)
+    except Exception as e:
+        logging.error(f"Error adding user {user_id} to guild: {e!r}")
+
+# OAuth calls the server makes itself (guild calls go through discord.py, which
+# handles rate limits on its own). The semaphore only caps how many are in flight
+# at once during a burst; it is not a rate limit, so 429s are still waited out here.
+DISCORD_CONCURRENCY = 50
+DISCORD_MAX_ATTEMPTS = 3
+DISCORD_MAX_RETRY_AFTER = 5.0  # seconds; a longer wait fails fast instead of holding the user
+discord_semaphore = asyncio.Semaphore(DISCORD_CONCURRENCY)
+
+async def discord_retry_after(resp) -> float:
+    """Seconds to wait after a 429: the Retry-After header, else the JSON body's retry_after."""
+    retry_after = resp.headers.get("Retry-After")
+    # 429s from Discord's edge (e.g. Cloudflare bans) can be HTML; only parse real JSON
+    if retry_after is None and resp.content_type == "application/json":
+        body = await resp.json(loads=orjson.loads)
+        if isinstance(body, dict):
+            retry_after = body.get("retry_after")
+    try:
+        return float(retry_after or 1)
+    except (TypeError, ValueError):
+        return 1.0
+
+async def discord_request(session, method, url, **kwargs):
+    """Call the Discord API, waiting out 429s per Retry-After. Returns the decoded JSON body,
+    or an empty dict if still rate limited after DISCORD_MAX_ATTEMPTS."""
+    for attempt in range(1, DISCORD_MAX_ATTEMPTS + 1):
+        async with discord_semaphore:
+            async with session.request(method, url, **kwargs) as resp:
+                if resp.status != 429:
+                    return await resp.json(loads=orjson.loads)
+                retry_after = await discord_retry_after(resp)
+        
+        if attempt == DISCORD_MAX_ATTEMPTS or retry_after > DISCORD_MAX_RETRY_AFTER:
+            break
+        logging.warning(f"Rate limited by Discord on {url}, retrying in {retry_after}s")
+        await asyncio.sleep(retry_after)
+    
+    logging.error(f"Giving up on {url} after being rate limited by Discord")
+    return {}
 
 @routes.get("/bot/callback")
 async def oauth_callback(request):
     code  = request.query.get("code")
     state = request.query.get("state")
-    role_key = validate_and_mark(state)
+    # Reject malformed states before any signature or database work
+    if not state or not (TOKEN_RE.fullmatch(state) or LEGACY_TOKEN_RE.fullmatch(state)):
+        return web.Response(text="Invalid state", status=400)
+    role_key = await validate_and_mark(state)
 
     if not code or not role_key:
         return web.Response(text="Invalid, expired, or already-used link", status=400)
 
     # Exchange code for access token
-    token_data = {
-        "client_id":     CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type":    "authorization_code",
-        "code":          code,
-        "redirect_uri":  REDIRECT_URI,
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    async with ClientSession() as session:
-        async with session.post("https://discord.com/api/oauth2/token", data=token_data, headers=headers) as resp:
-            token_json = await resp.json()
-    access_token = token_json.get("access_token")
-    if not access_token:
-        return web.Response(text="Token exchange failed", status=400)
-
-    # Fetch user ID
-    async with ClientSession() as session:
-        async with session.get(
-            "https://discord.com/api/users/@me",
-            headers={"Authorization": f"Bearer {access_token}"}
-        ) as resp:
-            user_json = await resp.json()
-    user_id = user_json.get("id")
-
-    # Add user to guild & assign role
-    bot_headers = {"Authorization": f"Bot {BOT_TOKEN}", "Content-Type": "application/json"}
-    async with ClientSession() as session:
-        await session.put(
-            f"https://discord.com/api/guilds/{GUILD_ID}/members/{user_id}",
-            json={"access_token": access_token},
-            headers=bot_headers
+    token_data = {**OAUTH_TOKEN_REQUEST, "code": code}
+    # Shared session: all calls below reuse pooled keep-alive connections to discord.com
+    session = request.app[HTTP_SESSION_KEY]
+    try:
+        token_json = await discord_request(
+            session, "POST", "https://discord.com/api/oauth2/token",
+            data=token_data, headers=OAUTH_TOKEN_HEADERS,
         )
-        role_id = ROLE_MAP[role_key]
-        await session.put(
-            f"https://discord.com/api/guilds/{GUILD_ID}/members/{user_id}/roles/{role_id}",
-            headers=bot_headers
+        access_token = token_json.get("access_token")
+        if not access_token:
+            return web.Response(text="Token exchange failed", status=400)
+
+        # Fetch user ID
+        user_json = await discord_request(
+            session, "GET", "https://discord.com/api/users/@me",
+            headers={"Authorization": f"Bearer {access_token}"},
         )
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logging.error(f"Discord API request failed during OAuth callback: {e!r}")
+        return web.Response(text="Discord did not respond, please contact the Admins", status=502)
+    user_id = user_json.get("id")
+    if not user_id:
+        return web.Response(text="Could not fetch Discord user", status=400)
+
+    # Add user to guild & assign role in the background; the redirect doesn't need to wait
+    task = asyncio.create_task(add_member_with_role(user_id, access_token, ROLE_MAP[role_key]))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
     # Final redirect back into Discord
     raise web.HTTPFound(location=INVITE_URL)
@@ -548,91 +992,182 @@ async def oauth_callback(request):
 @routes.get("/cleanup")
 async def cleanup_tokens(request):
     """Manual endpoint to cleanup expired tokens."""
-    cleanup_expired_tokens()
+    # Same rule as the scheduled purge, so used registrations are never deleted
+    await purge_stale_tokens()
     return web.Response(text="Expired tokens cleaned up successfully")
 
 # Health check endpoint
 @routes.get("/health")
 async def health_check(request):
-    return web.json_response({"status": "healthy"})
+    return json_response({"status": "healthy"})
 
 # Admin route to view tokens (for debugging)
+ADMIN_TOKENS_PAGE_MAX = 500
+
+# SQLite renders each row as JSON with JSON1 (skills/books are stored as JSON already).
+# Rows are joined in Python: json_group_array's element order is not guaranteed without
+# its own ORDER BY clause, which needs SQLite 3.44+, but the outer ORDER BY here is.
+ADMIN_TOKENS_SQL = '''
+    SELECT json_object(
+        'id', id, 'role_key', role_key, 'email', email, 'name', name,
+        'location', location, 'describe_yourself', describe_yourself, 'year', year,
+        'background', background, 'github', github, 'time', time, 'why', why,
+        'skills', json(COALESCE(skills, '[]')), 'books', json(COALESCE(books, '[]')),
+        'enrolled', json(CASE WHEN enrolled THEN 'true' ELSE 'false' END),
+        'cohort_name', cohort_name, 'hear_from', hear_from,
+        'created_at', created_at, 'expires_at', expires_at,
+        'used', json(CASE WHEN used THEN 'true' ELSE 'false' END),
+        'email_sent', json(CASE WHEN email_sent THEN 'true' ELSE 'false' END)
+    )
+    FROM tokens ORDER BY created_at DESC LIMIT ? OFFSET ?
+'''
+
 @routes.get("/bot/admin/tokens")
 async def view_tokens(request):
-    """Admin endpoint to view all tokens (for debugging)"""
+    """Admin endpoint to view tokens, newest first (?limit=50&offset=0)"""
+    try:
+        limit = min(int(request.query.get("limit", 50)), ADMIN_TOKENS_PAGE_MAX)
+        offset = int(request.query.get("offset", 0))
+    except ValueError:
+        return json_response({"error": "limit and offset must be integers"}, status=400)
+    if limit < 0 or offset < 0:
+        return json_response({"error": "limit and offset must not be negative"}, status=400)
+    
     try:
-        with get_db_connection() as conn:
-            cursor = conn.execute('''
-                SELECT id, role_key, email, name, location, describe_yourself, year, background, 
-                       github, time, why, skills, books, enrolled, cohort_name, hear_from,
-                       created_at, expires_at, used, email_sent
-                FROM tokens 
-                ORDER BY created_at DESC 
-                LIMIT 50
-            ''')
-            tokens = []
-            for row in cursor.fetchall():
-                # Parse JSON fields back to lists
-                skills = json.loads(row["skills"]) if row["skills"] else []
-                books = json.loads(row["books"]) if row["books"] else []
-                
-                tokens.append({
-                    "id": row["id"],
-                    "role_key": row["role_key"],
-                    "email": row["email"],
-                    "name": row["name"],
-                    "location": row["location"],
-                    "describe_yourself": row["describe_yourself"],
-                    "year": row["year"],
-                    "background": row["background"],
-                    "github": row["github"],
-                    "time": row["time"],
-                    "why": row["why"],
-                    "skills": skills,
-                    "books": books,
-                    "enrolled": bool(row["enrolled"]),
-                    "cohort_name": row["cohort_name"],
-                    "hear_from": row["hear_from"],
-                    "created_at": row["created_at"],
-                    "expires_at": row["expires_at"],
-                    "used": bool(row["used"]),
-                    "email_sent": bool(row["email_sent"])
-                })
+        async with get_db_connection() as conn:
+            cursor = await conn.execute(ADMIN_TOKENS_SQL, (limit, offset))
+            rows = await cursor.fetchall()
         
-        return web.json_response({"tokens": tokens})
+        body = '{"tokens":[' + ",".join(row[0] for row in rows) + ']}'
+        return web.Response(text=body, content_type="application/json")
     except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
+        return json_response({"error": str(e)}, status=500)
 
-# App setup
-app = web.Application()
-app.add_routes(routes)
+def orjson_dumps(obj) -> str:
+    """Serialize with orjson; aiohttp expects a str from its JSON serializer."""
+    return orjson.dumps(obj).decode()
 
-# Setup CORS
-cors = cors_setup(app, defaults={
-    "*": ResourceOptions(
-        allow_credentials=True,
-        expose_headers="*",
-        allow_headers="*",
-        allow_methods="*"
-    )
+def json_response(data, **kwargs) -> web.Response:
+    """Like web.json_response, but orjson writes the body bytes directly."""
+    return web.Response(body=orjson.dumps(data), content_type="application/json", **kwargs)
+
+async def close_http_session(app):
+    """Close the shared outbound HTTP session on shutdown."""
+    await app[HTTP_SESSION_KEY].close()
+
+# CORS for every route: any origin, with credentials (so the origin is echoed, not "*")
+def cors_headers(origin):
+    """Headers granting the requesting origin access, credentials included."""
+    return {
+        "Access-Control-Allow-Origin": origin,
+        "Access-Control-Allow-Credentials": "true",
+        "Vary": "Origin",
+    }
+
+# Readable by scripts without being exposed (CORS-safelisted response headers)
+SAFELISTED_RESPONSE_HEADERS = frozenset({
+    "cache-control", "content-language", "content-length", "content-type",
+    "expires", "last-modified", "pragma",
 })
 
-# Add CORS to all routes
-for route in list(app.router.routes()):
-    cors.add(route)
+def expose_headers(headers):
+    """Let scripts read every other header on the response, as expose_headers="*" did."""
+    names = [name for name in headers if name.lower() not in SAFELISTED_RESPONSE_HEADERS]
+    if names:
+        headers["Access-Control-Expose-Headers"] = ", ".join(names)
+
+@web.middleware
+async def cors_middleware(request, handler):
+    origin = request.headers.get("Origin")
+    if origin is None:
+        return await handler(request)
+    
+    if request.method == "OPTIONS" and "Access-Control-Request-Method" in request.headers:
+        # Preflight: answer directly, no route lookup needed
+        response = web.Response()
+        response.headers["Access-Control-Allow-Methods"] = request.headers["Access-Control-Request-Method"]
+        if "Access-Control-Request-Headers" in request.headers:
+            response.headers["Access-Control-Allow-Headers"] = request.headers["Access-Control-Request-Headers"]
+    else:
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            expose_headers(e.headers)
+            e.headers.update(cors_headers(origin))  # redirects and errors carry them too
+            raise
+        expose_headers(response.headers)
+    
+    response.headers.update(cors_headers(origin))
+    return response
+
+# Typed keys for the state main() stores on the app
+HTTP_SESSION_KEY = web.AppKey("http", ClientSession)
+TOKEN_WRITER_KEY = web.AppKey("token_writer", asyncio.Task)
+TOKEN_CLEANUP_KEY = web.AppKey("token_cleanup", asyncio.Task)
+SMTP_KEEPALIVE_KEY = web.AppKey("smtp_keepalive", asyncio.Task)
+BOT_LOGIN_KEY = web.AppKey("bot_login", asyncio.Task)
+
+# App setup
+app = web.Application(middlewares=[cors_middleware])
+app.add_routes(routes)
 
 async def main():
     # Initialize the database
     init_database()
+    await open_database()
+    app[TOKEN_WRITER_KEY] = asyncio.create_task(flush_pending_tokens())
+    app.on_cleanup.append(stop_token_writer)
+    if TOKEN_CLEANUP_INTERVAL > 0:
+        app[TOKEN_CLEANUP_KEY] = asyncio.create_task(purge_stale_tokens_periodically())
+        app.on_cleanup.append(stop_token_cleanup)
+    app.on_cleanup.append(close_database)
+    app[SMTP_KEEPALIVE_KEY] = asyncio.create_task(smtp_pool.keepalive())
+    app.on_cleanup.append(close_smtp_pool)
     
+    # One outbound session for the app's lifetime (created on the running loop)
+    app[HTTP_SESSION_KEY] = ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100, limit_per_host=30, ttl_dns_cache=300, enable_cleanup_closed=True,
+            keepalive_timeout=75,  # keep idle TLS connections to discord.com warm between callbacks
+        ),
+        # Bound every Discord call so a hung request can't pin a handler forever
+        timeout=aiohttp.ClientTimeout(total=10, connect=3, sock_read=5),
+        json_serialize=orjson_dumps,
+    )
+    app.on_cleanup.append(close_http_session)
+    
+    # Log the bot in while the HTTP server starts; member adds wait for it
+    app[BOT_LOGIN_KEY] = asyncio.create_task(bot.login(BOT_TOKEN))
     runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, "127.0.0.1", 8080)
-    await site.start()
-    print("OAuth server listening on http://127.0.0.1:8080")
-    print(f"Using SQLite database: {DB_PATH}")
-    print(f"Email method: {EMAIL_METHOD}")
-    await bot.start(BOT_TOKEN)
+    try:
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 8080)
+        await site.start()
+        print("OAuth server listening on http://127.0.0.1:8080")
+        print(f"Using SQLite database: {DB_PATH}")
+        print(f"Email method: {EMAIL_METHOD}")
+        
+        await app[BOT_LOGIN_KEY]
+        print(f"Bot logged in as {bot.user} ({bot.user.id})")
+        await asyncio.Event().wait()  # serve until cancelled
+    finally:
+        app[BOT_LOGIN_KEY].cancel()
+        await runner.cleanup()
+        # Let member adds already started by callbacks finish before the bot's session closes
+        if background_tasks:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*background_tasks, return_exceptions=True),
+                    BACKGROUND_DRAIN_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                logging.error(f"Gave up on {len(background_tasks)} member adds at shutdown")
+        await bot.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        import uvloop
+    except ImportError:  # uvloop has no Windows build
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
\ No newline at end of file